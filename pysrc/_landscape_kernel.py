@@ -0,0 +1,128 @@
+"""
+Innermost landscape query kernels, kept as plain Python source so
+they can be AOT-compiled to a C extension with pythran:
+
+    pythran -march=native -DUSE_XSIMD -o _landscape_kernel_pythran.so \
+        _landscape_kernel.py
+
+landscape.py prefers such a build when one is importable and
+otherwise JITs these functions with numba, so nothing here may use
+anything outside the numpy subset both compilers understand.
+"""
+import numpy as np
+
+
+def in_tri(x, y, t, tri2vert, verts_x, verts_y, tri_v0, tri_v1, inv_det):
+    """
+    Edge-sign point-in-triangle test: three cross products, each
+    normalized by inv_det so "inside" is simply all three positive
+    regardless of the triangle winding.
+    """
+    v2x = x - verts_x[tri2vert[t, 0]]
+    v2y = y - verts_y[tri2vert[t, 0]]
+    s = inv_det[t]
+    c0 = (tri_v0[t, 0]*v2y - tri_v0[t, 1]*v2x)*s
+    if c0 <= 0:
+        return False
+    c1 = ((tri_v1[t, 0] - tri_v0[t, 0])*(v2y - tri_v0[t, 1])
+          - (tri_v1[t, 1] - tri_v0[t, 1])*(v2x - tri_v0[t, 0]))*s
+    if c1 <= 0:
+        return False
+    c2 = (tri_v1[t, 1]*(v2x - tri_v1[t, 0])
+          - tri_v1[t, 0]*(v2y - tri_v1[t, 1]))*s
+    return c2 > 0
+
+
+# pythran export query(float64[], float64[], float32[:,:], float32[:,:],
+#                      int64[], int64[], int64[], int64[], int64[],
+#                      float32[:,:], float32[:,:], int64[:,:],
+#                      float32[], float32[], float32[:,:], float32[:,:],
+#                      float32[:,:], float32[:,:], float64[])
+def query(xs, ys, node_min, node_max, node_left, node_right,
+          node_tri_start, node_tri_count, bvh_tris, tri_min, tri_max,
+          tri2vert, verts_x, verts_y, plane_coef, normals,
+          tri_v0, tri_v1, inv_det):
+    """
+    Answer a batch of (x,y) height/normal queries against the BVH.
+
+    Returns (zs, norms) with zs NaN and norms zero where the point is
+    outside the grid.
+    """
+    nq = xs.shape[0]
+    zs = np.full(nq, np.nan)
+    norms = np.zeros((nq, 3))
+    stack = np.empty(64, dtype=np.int64)
+    for q in range(nq):
+        x = xs[q]
+        y = ys[q]
+        stack[0] = 0
+        sp = 1
+        while sp > 0:
+            sp -= 1
+            node = stack[sp]
+            if (x < node_min[node, 0] or x > node_max[node, 0] or
+                    y < node_min[node, 1] or y > node_max[node, 1]):
+                continue
+            if node_left[node] < 0:
+                start = node_tri_start[node]
+                for k in range(start, start + node_tri_count[node]):
+                    t = bvh_tris[k]
+                    # Cheapest rejection first: triangle AABB, then
+                    # edge signs, then (on the one hit) the plane
+                    if (x < tri_min[t, 0] or x > tri_max[t, 0] or
+                            y < tri_min[t, 1] or y > tri_max[t, 1]):
+                        continue
+                    if in_tri(x, y, t, tri2vert, verts_x, verts_y,
+                              tri_v0, tri_v1, inv_det):
+                        zs[q] = (plane_coef[t, 0]*x
+                                 + plane_coef[t, 1]*y + plane_coef[t, 2])
+                        norms[q, 0] = normals[t, 0]
+                        norms[q, 1] = normals[t, 1]
+                        norms[q, 2] = normals[t, 2]
+                        sp = 0
+                        break
+            else:
+                stack[sp] = node_left[node]
+                stack[sp + 1] = node_right[node]
+                sp += 2
+    return zs, norms
+
+
+# pythran export query_grid(float64[], float64[], float, float, float,
+#                           int, int, int64[], int64[],
+#                           float32[:,:], float32[:,:], int64[:,:],
+#                           float32[], float32[], float32[:,:],
+#                           float32[:,:], float32[:,:], float32[:,:],
+#                           float64[])
+def query_grid(xs, ys, x0, y0, inv_cell, nx, ny, cell_off, cell_tri,
+               tri_min, tri_max, tri2vert, verts_x, verts_y,
+               plane_coef, normals, tri_v0, tri_v1, inv_det):
+    """
+    Grid-broad-phase twin of query: the candidates come from one
+    uniform cell lookup instead of a BVH walk.
+    """
+    nq = xs.shape[0]
+    zs = np.full(nq, np.nan)
+    norms = np.zeros((nq, 3))
+    for q in range(nq):
+        x = xs[q]
+        y = ys[q]
+        ix = int(np.floor((x - x0)*inv_cell))
+        iy = int(np.floor((y - y0)*inv_cell))
+        if ix < 0 or ix >= nx or iy < 0 or iy >= ny:
+            continue
+        cell = iy*nx + ix
+        for k in range(cell_off[cell], cell_off[cell + 1]):
+            t = cell_tri[k]
+            if (x < tri_min[t, 0] or x > tri_max[t, 0] or
+                    y < tri_min[t, 1] or y > tri_max[t, 1]):
+                continue
+            if in_tri(x, y, t, tri2vert, verts_x, verts_y,
+                      tri_v0, tri_v1, inv_det):
+                zs[q] = (plane_coef[t, 0]*x
+                         + plane_coef[t, 1]*y + plane_coef[t, 2])
+                norms[q, 0] = normals[t, 0]
+                norms[q, 1] = normals[t, 1]
+                norms[q, 2] = normals[t, 2]
+                break
+    return zs, norms
@@ -1,6 +1,88 @@
 import json
+import os
+
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # Fall back to the interpreted kernel if numba is not around
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# Triangles per BVH leaf before we stop splitting
+_BVH_LEAF_SIZE = 4
+
+# Bump when the precomputed-array layout changes so stale on-disk
+# caches are rebuilt instead of loaded
+_CACHE_VERSION = 2
+
+# Everything derived from the mesh in __init__, in cache order
+_CACHE_KEYS = ('verts', 'tri2vert', 'z_min',
+               'verts_x', 'verts_y', 'verts_z',
+               'vert2tri_off', 'vert2tri_idx',
+               'plane_coef', 'normals', 'tri_v0', 'tri_v1', 'inv_det',
+               'tri_min', 'tri_max', 'node_min', 'node_max',
+               'node_left', 'node_right', 'node_tri_start',
+               'node_tri_count', 'bvh_tris',
+               'grid_x0', 'grid_y0', 'grid_inv_cell', 'grid_nx',
+               'grid_ny', 'cell_off', 'cell_tri', 'use_grid')
+
+
+# The innermost point-query kernels live in _landscape_kernel.py in
+# plain Python. Prefer an AOT pythran build of that module (SIMD
+# autovectorized C++, no JIT warmup) when one has been compiled; fall
+# back to JITting the same source with numba, or to the interpreter.
+try:
+    from _landscape_kernel_pythran import query as _query, \
+        query_grid as _query_grid
+except ImportError:
+    import _landscape_kernel as _lk
+    try:
+        from numba import njit as _kernel_njit
+        _lk.in_tri = _kernel_njit(cache=True, fastmath=True,
+                                  inline='always')(_lk.in_tri)
+        _query = _kernel_njit(cache=True, fastmath=True)(_lk.query)
+        _query_grid = _kernel_njit(cache=True, fastmath=True)(_lk.query_grid)
+    except ImportError:
+        _query = _lk.query
+        _query_grid = _lk.query_grid
+
+
+@njit(cache=True)
+def _aabb_query(xmin, xmax, ymin, ymax, node_min, node_max, node_left,
+                node_right, node_tri_start, node_tri_count, bvh_tris,
+                tri_min, tri_max):
+    """
+    Collect the triangles whose AABB overlaps the query box.
+    """
+    out = np.empty(bvh_tris.shape[0], dtype=np.int64)
+    n_out = 0
+    stack = np.empty(64, dtype=np.int64)
+    stack[0] = 0
+    sp = 1
+    while sp > 0:
+        sp -= 1
+        node = stack[sp]
+        if (xmax < node_min[node, 0] or xmin > node_max[node, 0] or
+                ymax < node_min[node, 1] or ymin > node_max[node, 1]):
+            continue
+        if node_left[node] < 0:
+            start = node_tri_start[node]
+            for k in range(start, start + node_tri_count[node]):
+                t = bvh_tris[k]
+                if not (xmax < tri_min[t, 0] or xmin > tri_max[t, 0] or
+                        ymax < tri_min[t, 1] or ymin > tri_max[t, 1]):
+                    out[n_out] = t
+                    n_out += 1
+        else:
+            stack[sp] = node_left[node]
+            stack[sp + 1] = node_right[node]
+            sp += 2
+    return out[:n_out]
+
 class landscape():
     """
     Landscape class to hold the ground specification.
@@ -10,8 +92,8 @@ class landscape():
     self.grid - z value of the landscape, such that
         self.grid[i,j] is at self.x[i] and self.y[j]
     """
-    @classmethod 
-    def load(cls, fname)
+    @classmethod
+    def load(cls, fname):
         """
         Generate a new landscape instance via loading
         in a landscape from a JSON file with the following format:
@@ -29,12 +111,63 @@ class landscape():
         v1, v2, and v3 are the indices for the triangles.
         Note that this does NOT do 3-D shapes, just a 2-D surface.
         Thus no 2 verts should share x and y
+
+        The precomputed arrays are cached on disk next to the JSON
+        file; a cache newer than the JSON short-circuits both the
+        parse and all the construction work.
         """
+        cache = cls._cachePath(fname)
+        if (os.path.exists(cache)
+                and os.path.getmtime(cache) >= os.path.getmtime(fname)):
+            with np.load(cache) as data:
+                if ('cache_version' in data.files
+                        and int(data['cache_version']) == _CACHE_VERSION):
+                    return cls._fromCache(data)
+
         with open(fname, 'r') as f:
             data = json.load(f)
-        return cls(data['verts'], data['tri'])
+        ls = cls(data['verts'], data['tri'])
+        ls._saveCache(cache)
+        return ls
+
+    @staticmethod
+    def _cachePath(fname):
+        """
+        Path of the precompute cache for a landscape JSON file.
+        """
+        return fname + '.cache.npz'
 
-    def __init__(self, verts, tris, grid):
+    @classmethod
+    def _fromCache(cls, data):
+        """
+        Build an instance straight from cached arrays, skipping
+        __init__ entirely.
+        """
+        ls = cls.__new__(cls)
+        for key in _CACHE_KEYS:
+            setattr(ls, key, data[key])
+        # npz stores scalars as 0-d arrays; restore the native types
+        ls.z_min = float(ls.z_min)
+        ls.grid_x0 = float(ls.grid_x0)
+        ls.grid_y0 = float(ls.grid_y0)
+        ls.grid_inv_cell = float(ls.grid_inv_cell)
+        ls.grid_nx = int(ls.grid_nx)
+        ls.grid_ny = int(ls.grid_ny)
+        ls.use_grid = bool(ls.use_grid)
+        return ls
+
+    def _saveCache(self, cache):
+        """
+        Save all the precomputed arrays next to the landscape file.
+        A failure to write (e.g. a read-only directory) is not fatal.
+        """
+        try:
+            np.savez(cache, cache_version=_CACHE_VERSION,
+                     **{key: getattr(self, key) for key in _CACHE_KEYS})
+        except OSError:
+            pass
+
+    def __init__(self, verts, tris):
         self.verts = np.array(verts)
         if self.verts.shape[1] != 3:
             raise LandscapeException('All vertices must contain 3 values for x,y,z')
@@ -42,15 +175,193 @@ class landscape():
         self.tri2vert = np.array(tris)
         if self.tri2vert.shape[1] != 3:
             raise LandscapeException('All triangles must contain 3 vertex indices')
-        self._funcs   = [None]*len(self.tri2vert)
-        self._normals = [None]*len(self.tri2vert)
+        self.z_min = self.verts[:, 2].min()
+
+        # SoA copies of the vertex columns; the query kernels want
+        # unit-stride loads rather than strided slices of the (N,3)
+        # array. Geometry is stored single precision - terrain data is
+        # nowhere near 1e-7 relative accuracy and the hot paths are
+        # memory bound - while the construction math stays double.
+        self.verts_x = np.ascontiguousarray(self.verts[:, 0], dtype=np.float32)
+        self.verts_y = np.ascontiguousarray(self.verts[:, 1], dtype=np.float32)
+        self.verts_z = np.ascontiguousarray(self.verts[:, 2], dtype=np.float32)
+        self._buildPlanes()
+
+        # Build the reverse (vertex -> incident triangles) adjacency
+        # in packed CSR form: the triangles around vertex v are
+        # vert2tri_idx[vert2tri_off[v]:vert2tri_off[v+1]]
+        degrees = np.bincount(self.tri2vert.ravel(),
+                              minlength=len(self.verts))
+        self.vert2tri_off = np.concatenate(
+            ([0], np.cumsum(degrees))).astype(np.int32)
+        order = np.argsort(self.tri2vert.ravel(), kind='stable')
+        self.vert2tri_idx = (order // 3).astype(np.int32)
+
+        self._buildBVH()
+        self._buildGrid()
+
+    def _buildPlanes(self):
+        """
+        Precompute the plane through every triangle directly from the
+        edge cross products, stored as contiguous arrays:
+
+        self.plane_coef - (T,3) coefficients (a,b,c) such that the
+            plane is z = a*x + b*y + c
+        self.normals - (T,3) unit normals, pointing up
+        """
+        p1 = self.verts[self.tri2vert[:, 0]]
+        p2 = self.verts[self.tri2vert[:, 1]]
+        p3 = self.verts[self.tri2vert[:, 2]]
+
+        # The (unnormalized) normal is the edge cross product; with it
+        # oriented upward, z = a*x + b*y + c falls straight out - no
+        # need to push T little systems through LAPACK
+        n = np.cross(p2 - p1, p3 - p1)
+        n *= np.sign(n[:, 2])[:, None]
+        plane_coef = np.empty((len(self.tri2vert), 3))
+        plane_coef[:, 0] = -n[:, 0]/n[:, 2]
+        plane_coef[:, 1] = -n[:, 1]/n[:, 2]
+        plane_coef[:, 2] = (p1[:, 2] - plane_coef[:, 0]*p1[:, 0]
+                            - plane_coef[:, 1]*p1[:, 1])
+
+        normals = n/np.linalg.norm(n, axis=1, keepdims=True)
+
+        # Edge vectors and inverse determinant for the barycentric
+        # point-in-triangle test, precomputed once per triangle
+        tri_v0 = p2[:, :2] - p1[:, :2]
+        tri_v1 = p3[:, :2] - p1[:, :2]
+        # inv_det stays double: near-degenerate triangles lose too
+        # much of the determinant in single precision
+        self.inv_det = 1.0/(tri_v0[:, 0]*tri_v1[:, 1]
+                            - tri_v0[:, 1]*tri_v1[:, 0])
+
+        # Solved in double, stored single (see the verts_x comment)
+        self.plane_coef = plane_coef.astype(np.float32)
+        self.normals = normals.astype(np.float32)
+        self.tri_v0 = tri_v0.astype(np.float32)
+        self.tri_v1 = tri_v1.astype(np.float32)
 
-        # Build the reverse list
-        self.vert2tri = [[] for i in range(len(self.verts))]
-        for tri_idx, val in enumerate(self.tri2vert):
-            for vidx in val:
-                self.vert2tri[vidx].append(tri_idx)
-            
+    def _buildBVH(self):
+        """
+        Build an AABB bounding volume hierarchy over the triangles
+        in the x,y plane.
+
+        The tree is built top-down, splitting the triangles at the
+        median of their AABB centers along the longest node axis.
+        It is stored as flat arrays so queries only touch a few
+        contiguous buffers:
+
+        self.node_min, self.node_max - (M,2) node AABBs
+        self.node_left, self.node_right - child indices (-1 for leaves)
+        self.node_tri_start, self.node_tri_count - leaf slice into
+            self.bvh_tris, a permutation of the triangle indices
+        """
+        # Per triangle AABBs
+        tx = self.verts[self.tri2vert, 0]
+        ty = self.verts[self.tri2vert, 1]
+        self.tri_min = np.ascontiguousarray(
+            np.stack([tx.min(axis=1), ty.min(axis=1)], axis=1), dtype=np.float64)
+        self.tri_max = np.ascontiguousarray(
+            np.stack([tx.max(axis=1), ty.max(axis=1)], axis=1), dtype=np.float64)
+        centers = .5*(self.tri_min + self.tri_max)
+
+        ntri = len(self.tri2vert)
+        max_nodes = max(2*ntri, 1)
+        node_min = np.empty((max_nodes, 2))
+        node_max = np.empty((max_nodes, 2))
+        node_left  = np.full(max_nodes, -1, dtype=np.int64)
+        node_right = np.full(max_nodes, -1, dtype=np.int64)
+        node_tri_start = np.zeros(max_nodes, dtype=np.int64)
+        node_tri_count = np.zeros(max_nodes, dtype=np.int64)
+        order = np.arange(ntri, dtype=np.int64)
+
+        num_nodes = 1
+        todo = [(0, 0, ntri)]
+        while todo:
+            node, lo, hi = todo.pop()
+            idx = order[lo:hi]
+            node_min[node] = self.tri_min[idx].min(axis=0)
+            node_max[node] = self.tri_max[idx].max(axis=0)
+            if hi - lo <= _BVH_LEAF_SIZE:
+                node_tri_start[node] = lo
+                node_tri_count[node] = hi - lo
+                continue
+            # Median split along the longest axis of this node
+            axis = np.argmax(node_max[node] - node_min[node])
+            mid = (lo + hi)//2
+            part = np.argpartition(centers[idx, axis], mid - lo)
+            order[lo:hi] = idx[part]
+            node_left[node]  = num_nodes
+            node_right[node] = num_nodes + 1
+            todo.append((num_nodes, lo, mid))
+            todo.append((num_nodes + 1, mid, hi))
+            num_nodes += 2
+
+        # Store the AABBs single precision, rounded outward an ulp so
+        # the cast can never shrink a box past a point it contained
+        self.tri_min = np.nextafter(self.tri_min.astype(np.float32), -np.inf)
+        self.tri_max = np.nextafter(self.tri_max.astype(np.float32), np.inf)
+        self.node_min = np.nextafter(node_min[:num_nodes].astype(np.float32),
+                                     -np.inf)
+        self.node_max = np.nextafter(node_max[:num_nodes].astype(np.float32),
+                                     np.inf)
+        self.node_left  = node_left[:num_nodes]
+        self.node_right = node_right[:num_nodes]
+        self.node_tri_start = node_tri_start[:num_nodes]
+        self.node_tri_count = node_tri_count[:num_nodes]
+        self.bvh_tris = order
+
+    def _buildGrid(self):
+        """
+        Build a uniform-grid broad phase over the triangle AABBs, as
+        an alternative to the BVH for point queries.
+
+        Each triangle is bucketed into every cell its AABB overlaps,
+        stored CSR-style in self.cell_off / self.cell_tri. On nearly
+        regular meshes (raster-DEM triangulations) a cell lookup is
+        two multiplies and a slice, cheaper than a tree walk, so point
+        queries use the grid whenever the per-cell occupancy is even
+        (self.use_grid); lumpy meshes keep the BVH.
+        """
+        ntri = len(self.tri2vert)
+        ext = self.tri_max - self.tri_min
+        self.grid_x0, self.grid_y0 = self.tri_min.min(axis=0)
+        xmax, ymax = self.tri_max.max(axis=0)
+        # Cell around the mean triangle size, but never so fine that
+        # the table dwarfs the mesh
+        cell = max(ext.mean(),
+                   np.sqrt((xmax - self.grid_x0)*(ymax - self.grid_y0)
+                           / max(ntri, 1)))
+        self.grid_inv_cell = 1.0/cell
+        self.grid_nx = max(int(np.ceil((xmax - self.grid_x0)/cell)), 1)
+        self.grid_ny = max(int(np.ceil((ymax - self.grid_y0)/cell)), 1)
+
+        ix0 = np.clip(((self.tri_min[:, 0] - self.grid_x0)*self.grid_inv_cell)
+                      .astype(np.int64), 0, self.grid_nx - 1)
+        ix1 = np.clip(((self.tri_max[:, 0] - self.grid_x0)*self.grid_inv_cell)
+                      .astype(np.int64), 0, self.grid_nx - 1)
+        iy0 = np.clip(((self.tri_min[:, 1] - self.grid_y0)*self.grid_inv_cell)
+                      .astype(np.int64), 0, self.grid_ny - 1)
+        iy1 = np.clip(((self.tri_max[:, 1] - self.grid_y0)*self.grid_inv_cell)
+                      .astype(np.int64), 0, self.grid_ny - 1)
+
+        ncell = self.grid_nx*self.grid_ny
+        counts = np.zeros(ncell, dtype=np.int64)
+        for t in range(ntri):
+            for iy in range(iy0[t], iy1[t] + 1):
+                counts[iy*self.grid_nx + ix0[t]:iy*self.grid_nx + ix1[t] + 1] += 1
+        self.cell_off = np.concatenate(([0], np.cumsum(counts)))
+        fill = self.cell_off[:-1].copy()
+        self.cell_tri = np.empty(self.cell_off[-1], dtype=np.int64)
+        for t in range(ntri):
+            for iy in range(iy0[t], iy1[t] + 1):
+                for ix in range(ix0[t], ix1[t] + 1):
+                    cell = iy*self.grid_nx + ix
+                    self.cell_tri[fill[cell]] = t
+                    fill[cell] += 1
+
+        occupied = counts[counts > 0]
+        self.use_grid = bool(occupied.std() <= occupied.mean())
 
     def valueAndNormal(self, x, y):
         """
@@ -72,105 +383,87 @@ class landscape():
 
         Notes
         ------
-        If the point is on an edge or vertex, the normal is the average
-        of the surrounding normals.
-        """
-        # Find the closest point
-        pt = np.array([x,y])
-
-        # Calculate the norms of the difference between all the x,y points
-        dist = self.verts[:,:2] - pt
-        dist = dist**2
-        dist = dist.sum(axis=1)
-
-        closest_vidx = np.argmin(dist)
-
-        val = None
-        normal = []
-        # For all triangles it can be part of
-        for tri_idx in self.vert2tri[closest_vidx]:
-            if self._inTri(pt, tri_idx):
-                f, n = self._getPlane(tri_idx)
-                if val is None:
-                    val = f(pt)
-                elif val != f(pt):
-                    # This should never happen
-                    raise LandscapeException('Edge of triangles disagree on value')
-                normal.append(n)
-
-        if val is None:
+        Points exactly on an edge or vertex count as outside; the
+        first (only) containing triangle supplies the normal.
+        """
+        zs, norms = self._queryKernel(np.array([float(x)]), np.array([float(y)]))
+        if np.isnan(zs[0]):
             raise LandscapeException("Point outside of grid")
+        return zs[0], norms[0]
 
-        normal = np.array(normal)
-        normal = normal.mean(axis=0)
-
-        return val, normal
+    def _queryKernel(self, xs, ys):
+        """
+        Run the compiled query kernel over arrays of x and y values,
+        through whichever broad phase suits this mesh.
+        """
+        if self.use_grid:
+            return _query_grid(xs, ys, self.grid_x0, self.grid_y0,
+                               self.grid_inv_cell, self.grid_nx,
+                               self.grid_ny, self.cell_off, self.cell_tri,
+                               self.tri_min, self.tri_max,
+                               self.tri2vert, self.verts_x, self.verts_y,
+                               self.plane_coef, self.normals,
+                               self.tri_v0, self.tri_v1, self.inv_det)
+        return _query(xs, ys, self.node_min, self.node_max,
+                      self.node_left, self.node_right,
+                      self.node_tri_start, self.node_tri_count,
+                      self.bvh_tris, self.tri_min, self.tri_max,
+                      self.tri2vert, self.verts_x, self.verts_y,
+                      self.plane_coef, self.normals,
+                      self.tri_v0, self.tri_v1, self.inv_det)
 
-    def _inTri(pt, tri_idx):
+    def valueAndNormalBatch(self, xs, ys):
         """
-        Determine if a point is within a triangle
+        Get the Grid values and normals for a batch of (x,y) points
+        in a single vectorized pass.
 
-        Paramters
-        ---------
-        pt : array-like
-            (x,y) point
-        tri_idx : integer
-            index of triangle
+        Parameters
+        ----------
+        xs : array-like
+            x locations
+        ys : array-like
+            y locations
 
-        Results
+        Result
         -------
-        boolean
-            True if inside the triangle, False if outside
-        """
-        tri1 = self.verts[self.tri2vert[tri_idx][0]][:2]
-        tri2 = self.verts[self.tri2vert[tri_idx][1]][:2]
-        tri3 = self.verts[self.tri2vert[tri_idx][2]][:2]
+        zs : array-like
+            Heights at the (x,y) positions. NaN where the point is
+            outside the grid.
+        norms : array-like
+            (Q,3) surface normals. Zero rows where the point is
+            outside the grid.
 
-        A = np.stack([tri2 - tri1, tri3 - tri1], axis=1)
-        b = pt - tri1
-        
-        x = np.linalg.solve(A,b)
-
-        if 0 < x[0] < 1 and 0 < x[1] < 1:
-            return True
-        else:
-            return False
+        Notes
+        ------
+        Unlike valueAndNormal this does not raise for points outside
+        the grid, so callers sweeping a trajectory can decide what to
+        do with the first bad sample themselves.
+        """
+        xs = np.ascontiguousarray(xs, dtype=np.float64)
+        ys = np.ascontiguousarray(ys, dtype=np.float64)
+        return self._queryKernel(xs, ys)
 
+    def trianglesInAABB(self, xmin, xmax, ymin, ymax):
+        """
+        Get the triangles whose bounding box overlaps the given
+        (x,y) box.
 
+        Parameters
+        ----------
+        xmin, xmax, ymin, ymax : float
+            bounds of the query box
 
-    def _getPlane(self, tri_idx):
+        Result
+        ------
+        tris : array-like
+            indices of the candidate triangles
         """
-        Get the gradient and function to evaluate on this plane
+        return _aabb_query(float(xmin), float(xmax), float(ymin), float(ymax),
+                           self.node_min, self.node_max,
+                           self.node_left, self.node_right,
+                           self.node_tri_start, self.node_tri_count,
+                           self.bvh_tris, self.tri_min, self.tri_max)
 
-        Paramters
-        ---------
-        tri_idx : integer
-            Index of the triangle to use.
-
-        Results
-        -------
-        func : function
-            function which takes x,y and yields a value z
-        normal : array-like
-            A 3-element vector normal to the plane
-        """
-        if self._funcs[tri_idx] is None:
-            tri1 = self.verts[self.tri2vert[tri_idx][0]]
-            tri2 = self.verts[self.tri2vert[tri_idx][1]]
-            tri3 = self.verts[self.tri2vert[tri_idx][2]]
-
-            LHS = np.array([[tri1[0], tri2[1], 1],
-                            [tri2[0], tri2[1], 1],
-                            [tri3[0], tri3[1], 1]])
-            RHS = np.array([tri1[2], tri2[2], tri3[2]])
-            sol = np.linalg.solve(LHS, RHS)
-            normal = np.array([-sol[0], -sol[1], 1])
-            normal /= np.linalg.norm(normal)
-            self._normals[tri_idx] = normal
-            f = lambda x: x[0]*sol[0] + x[1]*sol[1] + sol[2]
-            self._funcs[tri_idx] = f
-
-        return self._funcs[tri_idx], self._normals[tri_idx]
 
 class LandscapeException(Exception):
     pass
@@ -0,0 +1,285 @@
+import math
+
+import numpy as np
+
+from landscape import LandscapeException, _aabb_query
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # Fall back to interpreted kernels if numba is not around
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+    prange = range
+
+# Gravity, pointing down
+_GRAVITY = -10.0
+
+
+@njit(cache=True, fastmath=True)
+def _bounce(px, py, pz, vx, vy, vz, z_min,
+            node_min, node_max, node_left, node_right,
+            node_tri_start, node_tri_count, bvh_tris, tri_min, tri_max,
+            tri2vert, verts_x, verts_y, plane_coef, normals,
+            tri_v0, tri_v1, inv_det):
+    """
+    Scalar bounce kernel: fly the parabola from (px,py,pz) with
+    velocity (vx,vy,vz) to its first triangle impact and reflect.
+
+    Returns (ok, x, y, z, vx, vy, vz); ok is False when the ball
+    leaves the landscape.
+    """
+    g2 = -.5*_GRAVITY
+    t_max = (vz + math.sqrt(vz*vz + 4.*g2*(pz - z_min + 1.)))/(2.*g2)
+    xmin = min(px, px + vx*t_max)
+    xmax = max(px, px + vx*t_max)
+    ymin = min(py, py + vy*t_max)
+    ymax = max(py, py + vy*t_max)
+    cands = _aabb_query(xmin, xmax, ymin, ymax, node_min, node_max,
+                        node_left, node_right, node_tri_start,
+                        node_tri_count, bvh_tris, tri_min, tri_max)
+
+    t_eps = 1e-3/math.sqrt(vx*vx + vy*vy + vz*vz)
+    best_t = np.inf
+    best_tri = -1
+    for i in range(cands.shape[0]):
+        t = cands[i]
+        a = plane_coef[t, 0]
+        b = plane_coef[t, 1]
+        c = plane_coef[t, 2]
+        B = vz - a*vx - b*vy
+        C = pz - a*px - b*py - c
+        disc = B*B + 4.*g2*C
+        if disc <= 0:
+            continue
+        sq = math.sqrt(disc)
+        for root in ((B - sq)/(2.*g2), (B + sq)/(2.*g2)):
+            if root <= t_eps or root >= best_t:
+                continue
+            xr = px + vx*root
+            yr = py + vy*root
+            v2x = xr - verts_x[tri2vert[t, 0]]
+            v2y = yr - verts_y[tri2vert[t, 0]]
+            u = (v2x*tri_v1[t, 1] - v2y*tri_v1[t, 0])*inv_det[t]
+            v = (tri_v0[t, 0]*v2y - tri_v0[t, 1]*v2x)*inv_det[t]
+            if u > 0 and v > 0 and u + v < 1:
+                best_t = root
+                best_tri = t
+
+    if best_tri < 0:
+        return False, 0., 0., 0., 0., 0., 0.
+
+    x_hit = px + vx*best_t
+    y_hit = py + vy*best_t
+    z_hit = (plane_coef[best_tri, 0]*x_hit
+             + plane_coef[best_tri, 1]*y_hit + plane_coef[best_tri, 2])
+    vzt = vz + _GRAVITY*best_t
+    nx = normals[best_tri, 0]
+    ny = normals[best_tri, 1]
+    nz = normals[best_tri, 2]
+    d = vx*nx + vy*ny + vzt*nz
+    return (True, x_hit, y_hit, z_hit,
+            vx - 2.*d*nx, vy - 2.*d*ny, vzt - 2.*d*nz)
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _throw_batch(azims, elevs, speeds, num_bounce, px, py, pz,
+                 z_min, node_min, node_max, node_left, node_right,
+                 node_tri_start, node_tri_count, bvh_tris, tri_min,
+                 tri_max, tri2vert, verts_x, verts_y, plane_coef,
+                 normals, tri_v0, tri_v1, inv_det):
+    """
+    Follow many independent throws in parallel, one per prange
+    iteration. Throws whose ball leaves the landscape come back as
+    NaN rows.
+    """
+    n = azims.shape[0]
+    out = np.empty((n, 3))
+    for k in prange(n):
+        a = math.radians(azims[k])
+        e = math.radians(elevs[k])
+        ce = math.cos(e)
+        vx = speeds[k]*ce*math.sin(a)
+        vy = speeds[k]*ce*math.cos(a)
+        vz = speeds[k]*math.sin(e)
+        x, y, z = px, py, pz
+        ok = True
+        for i in range(num_bounce):
+            ok, x, y, z, vx, vy, vz = _bounce(
+                x, y, z, vx, vy, vz, z_min, node_min, node_max,
+                node_left, node_right, node_tri_start, node_tri_count,
+                bvh_tris, tri_min, tri_max, tri2vert, verts_x, verts_y,
+                plane_coef, normals, tri_v0, tri_v1, inv_det)
+            if not ok:
+                break
+        if ok:
+            out[k, 0] = x
+            out[k, 1] = y
+            out[k, 2] = z
+        else:
+            out[k, 0] = np.nan
+            out[k, 1] = np.nan
+            out[k, 2] = np.nan
+    return out
+
+class Tosser():
+    """
+    Tosser which launches bouncing projectiles across a landscape.
+
+    self.landscape - the landscape the tosser stands on
+    self.pos - (x,y,z) launch position, with z on the surface
+    """
+    def __init__(self, ls, x, y):
+        self.landscape = ls
+        z, _ = ls.valueAndNormal(x, y)
+        self.pos = np.array([x, y, z])
+        # Landscape arrays in the order the bounce kernels take them
+        self._ls_args = (ls.z_min, ls.node_min, ls.node_max,
+                         ls.node_left, ls.node_right, ls.node_tri_start,
+                         ls.node_tri_count, ls.bvh_tris, ls.tri_min,
+                         ls.tri_max, ls.tri2vert, ls.verts_x, ls.verts_y,
+                         ls.plane_coef, ls.normals, ls.tri_v0, ls.tri_v1,
+                         ls.inv_det)
+
+    def throw(self, azim, elev, speed, num_bounce):
+        """
+        Throw a ball and report where it lands after num_bounce bounces.
+
+        Parameters
+        ----------
+        azim : float
+            azimuthal launch angle in degrees, clockwise from +y
+        elev : float
+            elevation launch angle in degrees above the horizon
+        speed : float
+            initial speed of the ball
+        num_bounce : integer
+            number of bounces to follow
+
+        Result
+        ------
+        pos : array-like
+            (x,y,z) position of the final bounce
+        """
+        a = math.radians(azim)
+        e = math.radians(elev)
+        ce = math.cos(e)
+        vel = speed*np.array([ce*math.sin(a), ce*math.cos(a), math.sin(e)])
+
+        pos = self.pos.copy()
+        for i in range(num_bounce):
+            pos, vel = self.bounce(pos, vel)
+        return pos
+
+    def throwBatch(self, azims, elevs, speeds, num_bounce):
+        """
+        Throw many balls at once, spread across the CPU cores.
+
+        Parameters
+        ----------
+        azims : array-like
+            azimuthal launch angles in degrees, clockwise from +y
+        elevs : array-like
+            elevation launch angles in degrees above the horizon
+        speeds : array-like
+            initial speeds of the balls
+        num_bounce : integer
+            number of bounces to follow for every throw
+
+        Result
+        ------
+        pos : array-like
+            (N,3) positions of the final bounces. Throws whose ball
+            left the landscape are NaN rows.
+        """
+        azims = np.ascontiguousarray(azims, dtype=np.float64)
+        elevs = np.ascontiguousarray(elevs, dtype=np.float64)
+        speeds = np.ascontiguousarray(speeds, dtype=np.float64)
+        return _throw_batch(azims, elevs, speeds, num_bounce,
+                            self.pos[0], self.pos[1], self.pos[2],
+                            *self._ls_args)
+
+    def bounce(self, pos, vel):
+        """
+        Follow the ball from pos with velocity vel until it hits the
+        landscape, and reflect the velocity about the surface normal.
+
+        Parameters
+        ----------
+        pos : array-like
+            (x,y,z) position the ball starts from (on the surface)
+        vel : array-like
+            (x,y,z) velocity of the ball
+
+        Result
+        ------
+        pos : array-like
+            (x,y,z) position of the impact
+        vel : array-like
+            reflected (x,y,z) velocity at the impact
+        """
+        ls = self.landscape
+        px, py, pz = pos
+        vx, vy, vz = vel
+        g2 = -.5*_GRAVITY
+        t_eps = 1e-3/math.sqrt(vx*vx + vy*vy + vz*vz)
+
+        # The flight only matters while the ball is above the lowest
+        # point of the landscape; bound the time by when it falls a
+        # little past that (the pad keeps a ball rolling on the lowest
+        # plane bracketed)
+        t_max = (vz + math.sqrt(vz*vz + 4.*g2*(pz - ls.z_min + 1.)))/(2.*g2)
+
+        # Broad phase: every triangle whose AABB overlaps the arc's
+        # (x,y) extent is an intersection candidate
+        cands = ls.trianglesInAABB(
+            min(px, px + vx*t_max), max(px, px + vx*t_max),
+            min(py, py + vy*t_max), max(py, py + vy*t_max))
+
+        # The parabola meets each candidate plane z = a*x + b*y + c
+        # where g2*t^2 - B*t - C = 0; solve all quadratics at once
+        a = ls.plane_coef[cands, 0]
+        b = ls.plane_coef[cands, 1]
+        c = ls.plane_coef[cands, 2]
+        B = vz - a*vx - b*vy
+        C = pz - a*px - b*py - c
+        disc = B*B + 4.*g2*C
+        sq = np.sqrt(np.maximum(disc, 0.))
+        roots = np.stack([(B - sq), (B + sq)])/(2.*g2)
+
+        # A root is a real hit if it is ahead of the ball (more than
+        # ~1mm of travel, so the plane just bounced off is excluded)
+        # and lands inside its triangle
+        xt = px + vx*roots
+        yt = py + vy*roots
+        v2x = xt - ls.verts_x[ls.tri2vert[cands, 0]]
+        v2y = yt - ls.verts_y[ls.tri2vert[cands, 0]]
+        u = (v2x*ls.tri_v1[cands, 1]
+             - v2y*ls.tri_v1[cands, 0])*ls.inv_det[cands]
+        v = (ls.tri_v0[cands, 0]*v2y
+             - ls.tri_v0[cands, 1]*v2x)*ls.inv_det[cands]
+        valid = ((u > 0) & (v > 0) & (u + v < 1)
+                 & (roots > t_eps) & (disc[None, :] > 0))
+        if not valid.any():
+            raise LandscapeException("Ball left the landscape")
+
+        flat = np.argmin(np.where(valid, roots, np.inf))
+        ri, ci = np.unravel_index(flat, roots.shape)
+        t_hit = roots[ri, ci]
+
+        # Scalar impact state; z is pinned onto the surface exactly
+        x_hit = px + vx*t_hit
+        y_hit = py + vy*t_hit
+        z_hit = a[ci]*x_hit + b[ci]*y_hit + c[ci]
+        new_pos = np.array([x_hit, y_hit, z_hit])
+
+        # Reflect the velocity about the surface normal, fused to
+        # v - 2*(v.n)*n in scalars so no intermediate vectors are built
+        nx, ny, nz = ls.normals[cands[ci]]
+        vzt = vz + _GRAVITY*t_hit
+        d = vx*nx + vy*ny + vzt*nz
+        new_vel = np.array([vx - 2.*d*nx, vy - 2.*d*ny, vzt - 2.*d*nz])
+
+        return new_pos, new_vel